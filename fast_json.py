@@ -0,0 +1,45 @@
+"""JSON 读写模块
+
+优先使用 orjson（C 扩展，序列化和解析都更快），未安装时回退到标准库 json。
+两种实现的输出一致：UTF-8 编码、不转义非 ASCII 字符、非字符串字典键转为字符串。
+"""
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - 可选依赖
+    orjson = None
+
+
+def dumps(obj: Any, pretty: bool = False) -> bytes:
+    """将对象序列化为 UTF-8 编码的 JSON 字节串
+
+    Args:
+        obj: 要序列化的对象
+        pretty: 是否使用两个空格缩进输出，默认为紧凑格式
+
+    Returns:
+        JSON 字节串
+    """
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option=option)
+
+    if pretty:
+        text = json.dumps(obj, ensure_ascii=False, indent=2)
+    else:
+        text = json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+    return text.encode('utf-8')
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    """解析 JSON 字节串或字符串
+
+    解析失败时抛出 json.JSONDecodeError（orjson 的异常也是其子类）。
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
@@ -8,8 +8,61 @@ Formula Management Module
 """
 
 import json
-from datetime import date, timedelta
-from typing import Dict, List, Optional, Any, Tuple
+from datetime import date
+from typing import Dict, Iterator, List, Optional, Any, Set, Tuple
+
+import fast_json
+
+# 定式状态在内存中使用整数编码，只在JSON读写时转换为文字
+STATUS_IDLE = 0
+STATUS_ACTIVE = 1
+_STATUS_NAMES = {STATUS_IDLE: "未执行", STATUS_ACTIVE: "活跃"}
+_STATUS_CODES = {name: code for code, name in _STATUS_NAMES.items()}
+
+
+class FormulaNode:
+    """定式节点（使用 __slots__ 减少每个节点的内存占用）"""
+
+    __slots__ = ('id', 'name', 'parent', 'children', 'status', 'last_active_ord')
+
+    def __init__(self, id: int, name: str, parent: Optional[int] = None,
+                 children: Optional[List[int]] = None, status: int = STATUS_IDLE,
+                 last_active_ord: Optional[int] = None):
+        self.id = id
+        self.name = name
+        self.parent = parent
+        self.children = children if children is not None else []
+        self.status = status
+        self.last_active_ord = last_active_ord  # 最后激活日期的序数日
+
+    @property
+    def status_text(self) -> str:
+        """状态的显示文字"""
+        return _STATUS_NAMES[self.status]
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> 'FormulaNode':
+        """从JSON记录创建节点（状态文字 -> 编码，ISO日期 -> 序数日）"""
+        last_active = data.get("last_active_time")
+        return cls(
+            id=data["id"],
+            name=data["name"],
+            parent=data.get("parent"),
+            children=list(data.get("children", [])),
+            status=_STATUS_CODES.get(data.get("status"), STATUS_IDLE),
+            last_active_ord=date.fromisoformat(last_active).toordinal() if last_active else None,
+        )
+
+    def to_json(self) -> Dict[str, Any]:
+        """转换为JSON记录（状态编码 -> 文字，序数日 -> ISO日期）"""
+        return {
+            "id": self.id,
+            "name": self.name,
+            "parent": self.parent,
+            "children": list(self.children),  # 复制，避免记录与节点共享列表
+            "status": self.status_text,
+            "last_active_time": date.fromordinal(self.last_active_ord).isoformat() if self.last_active_ord else None,
+        }
 
 
 class FormulaManager:
@@ -23,42 +76,109 @@ class FormulaManager:
             data_callback: 数据保存回调函数，用于与主系统同步数据
         """
         self.data_callback = data_callback
-        self._formulas = []
         self.last_addition_date = None
         self.active_tree_progress = {}  # 跟踪活跃定式树的进度
+        self._sorted_active: Optional[List[int]] = None  # 排序后的活跃树根ID，None表示需要重建
+        self._id_index: Dict[int, FormulaNode] = {}  # id -> 定式，按添加顺序保存全部定式
+        self._children_index: Dict[Optional[int], List[int]] = {}  # 父ID -> 子ID列表
+        self._root_index: Dict[int, int] = {}  # id -> 所在树的根ID
+        self._active_ids: Set[int] = set()  # 状态为活跃的定式ID
+        self._next_id = 1  # 下一个新定式的ID
+        # 每次数据变更递增，用于判断缓存是否失效
+        self._mutation_seq = 0
+        self._display_cache: Optional[Tuple[Tuple, str]] = None
+        self._data_cache: Optional[Tuple[int, Dict[str, Any]]] = None  # (版本号, get_formulas_data结果)
+        # 根ID -> (按层序展开的节点ID, 每层起始偏移)，该树结构变化时移除
+        self._flat_trees: Dict[int, Tuple[List[int], List[int]]] = {}
         self._load_default_formulas()
     
     def _load_default_formulas(self):
         """加载默认定式数据"""
-        self._formulas = [
-            {"id": 1, "name": "A定式", "parent": None, "children": [2, 3], "status": "活跃", "last_active_time": date.today().isoformat()},
-            {"id": 2, "name": "B定式", "parent": 1, "children": [4], "status": "活跃", "last_active_time": date.today().isoformat()},
-            {"id": 3, "name": "C定式", "parent": 1, "children": [], "status": "未执行", "last_active_time": None},
-            {"id": 4, "name": "D定式", "parent": 2, "children": [], "status": "未执行", "last_active_time": None}
-        ]
+        today = date.today().toordinal()
+        self._rebuild_index([
+            FormulaNode(1, "A定式", None, [2, 3], STATUS_ACTIVE, today),
+            FormulaNode(2, "B定式", 1, [4], STATUS_ACTIVE, today),
+            FormulaNode(3, "C定式", 1, [], STATUS_IDLE, None),
+            FormulaNode(4, "D定式", 2, [], STATUS_IDLE, None)
+        ])
+
+    def _rebuild_index(self, formulas: List[FormulaNode]):
+        """用给定的定式列表替换全部数据，并重建ID索引、父子索引、活跃集合和ID计数器"""
+        self._mutation_seq += 1
+        self._flat_trees = {}
+        self._next_id = max((f.id for f in formulas), default=0) + 1
+        self._id_index = {}
+        self._children_index = {}
+        self._active_ids = set()
+        for formula in formulas:
+            self._id_index[formula.id] = formula  # 重复ID以最后一条记录为准
+        for formula in self._id_index.values():
+            self._children_index.setdefault(formula.parent, []).append(formula.id)
+            if formula.status == STATUS_ACTIVE:
+                self._active_ids.add(formula.id)
+
+        # 从各根节点向下传播根ID（导入的数据不保证父节点排在子节点之前）
+        self._root_index = {}
+        for root_id in self._children_index.get(None, []):
+            stack = [root_id]
+            while stack:
+                node_id = stack.pop()
+                # 重复ID可能让父子关系成环，已访问的节点不再展开
+                if node_id in self._root_index:
+                    continue
+                self._root_index[node_id] = root_id
+                stack.extend(self._children_index.get(node_id, ()))
+        # 无法从根节点到达的定式（父节点缺失或父子关系成环）不保留子列表，
+        # 否则从它们开始的遍历可能无限循环
+        for node_id in self._id_index:
+            if node_id not in self._root_index:
+                self._children_index.pop(node_id, None)
     
     def set_formulas_data(self, data: Dict[str, Any]):
         """设置定式数据"""
-        self._formulas = data.get("formulas", [])
+        formulas = [FormulaNode.from_json(f) for f in data.get("formulas", [])]
         # 加载进度并确保键为 int 类型（JSON 会将字典键转换为字符串）
         raw_progress = data.get("active_tree_progress", {})
         self.active_tree_progress = {int(k): v for k, v in raw_progress.items()}
+        self._sorted_active = None
         last_date_str = data.get("last_addition_date")
         if last_date_str:
             self.last_addition_date = date.fromisoformat(last_date_str)
         else:
             self.last_addition_date = None
+        self._rebuild_index(formulas)
     
     def get_formulas_data(self) -> Dict[str, Any]:
-        """获取定式数据"""
+        """获取定式数据
+
+        结果按版本号缓存，数据未变化时直接返回同一个对象，调用方只能读取不能修改；
+        需要可修改的副本时使用 get_formulas_snapshot。
+        """
+        # 先读版本号：生成期间若有修改，缓存会标记为旧版本，下次调用时重建
+        seq = self._mutation_seq
+        cache = self._data_cache
+        if cache and cache[0] == seq:
+            return cache[1]
+        data = self.get_formulas_snapshot()
+        self._data_cache = (seq, data)
+        return data
+
+    def get_formulas_snapshot(self) -> Dict[str, Any]:
+        """获取定式数据的独立副本"""
         return {
-            "formulas": self._formulas,
+            "formulas": [f.to_json() for f in self._id_index.values()],
             "last_addition_date": self.last_addition_date.isoformat() if self.last_addition_date else None,
-            "active_tree_progress": self.active_tree_progress  # 保存进度
+            "active_tree_progress": dict(self.active_tree_progress)  # 保存进度
         }
     
+    @property
+    def version(self) -> int:
+        """数据版本号，每次定式数据或进度变化时递增"""
+        return self._mutation_seq
+
     def _save_data(self):
-        """保存数据（通过回调函数）"""
+        """保存数据（通过回调函数），同时使缓存失效"""
+        self._mutation_seq += 1
         if self.data_callback:
             self.data_callback()
     
@@ -73,27 +193,22 @@ class FormulaManager:
         Returns:
             格式化的树形结构字符串
         """
-        result = []
-        formulas = [f for f in self._formulas if f["parent"] == parent_id]
-        
-        for formula in formulas:
-            indent = "  " * level
-            result.append(f"{indent}📁 {formula['name']} (ID: {formula['id']})")
-            # 递归显示子节点
-            child_result = self.show_formula_tree(formula["id"], level + 1)
-            if child_result:
-                result.append(child_result)
-        
-        return "\n".join(result) if result else ""
+        result = [f"{'  ' * lvl}📁 {formula.name} (ID: {formula.id})"
+                  for formula, lvl in self._iter_tree(parent_id, level)]
+        return "\n".join(result)
     
     def print_formula_tree(self, parent_id=None, level=0):
         """打印定式树结构（用于命令行界面）"""
-        formulas = [f for f in self._formulas if f["parent"] == parent_id]
-        
-        for formula in formulas:
-            indent = "  " * level
-            print(f"{indent}📁 {formula['name']} (ID: {formula['id']})")
-            self.print_formula_tree(formula["id"], level + 1)
+        for formula, lvl in self._iter_tree(parent_id, level):
+            print(f"{'  ' * lvl}📁 {formula.name} (ID: {formula.id})")
+
+    def _iter_tree(self, parent_id=None, level=0) -> Iterator[Tuple[FormulaNode, int]]:
+        """按深度优先（先序）顺序迭代遍历子树，产出 (定式, 层级)"""
+        stack = [(child_id, level) for child_id in reversed(self._children_index.get(parent_id, []))]
+        while stack:
+            node_id, lvl = stack.pop()
+            yield self._id_index[node_id], lvl
+            stack.extend((child_id, lvl + 1) for child_id in reversed(self._children_index.get(node_id, [])))
     
     def add_formula(self, name: str, parent_id: Optional[int] = None) -> Tuple[bool, str]:
         """
@@ -107,36 +222,34 @@ class FormulaManager:
             (是否添加成功, 提示信息)
         """
         # 检查今天是否已经添加过
-        if self.last_addition_date == date.today():
+        today = date.today()
+        if self.last_addition_date == today:
             return False, "今天已经添加过一个定式了，请明天再试。"
 
         if not name.strip():
             return False, "定式名称不能为空。"
 
         # 验证父节点是否存在
-        if parent_id and not any(f["id"] == parent_id for f in self._formulas):
+        parent = self._id_index.get(parent_id) if parent_id else None
+        if parent_id and parent is None:
             return False, "父定式不存在。"
 
         # 创建新定式
-        new_id = max([f["id"] for f in self._formulas], default=0) + 1
-        new_formula = {
-            "id": new_id,
-            "name": name.strip(),
-            "parent": parent_id,
-            "children": [],
-            "status": "未执行",
-            "last_active_time": None
-        }
+        new_id = self._next_id
+        self._next_id += 1
+        new_formula = FormulaNode(new_id, name.strip(), parent_id)
 
         # 更新父节点的children
-        if parent_id:
-            for formula in self._formulas:
-                if formula["id"] == parent_id:
-                    formula["children"].append(new_id)
-                    break
-
-        self._formulas.append(new_formula)
-        self.last_addition_date = date.today()  # 更新添加日期
+        if parent:
+            parent.children.append(new_id)
+
+        self._id_index[new_id] = new_formula
+        self._children_index.setdefault(parent_id, []).append(new_id)
+        root_id = self._root_index.get(parent_id) if parent_id else new_id
+        if root_id is not None:
+            self._root_index[new_id] = root_id
+            self._flat_trees.pop(root_id, None)
+        self.last_addition_date = today  # 更新添加日期
         self._save_data()
         return True, f"定式 '{name.strip()}' 已成功添加。"
     
@@ -151,56 +264,65 @@ class FormulaManager:
         Returns:
             (是否删除成功, 被删除的定式名称列表)
         """
-        # 获取要删除的节点及其所有子节点
-        def get_descendants(node_id):
-            descendants = [node_id]
-            for formula in self._formulas:
-                if formula["parent"] == node_id:
-                    descendants.extend(get_descendants(formula["id"]))
-            return descendants
-        
-        to_delete = get_descendants(formula_id)
-        deleted_names = [f["name"] for f in self._formulas if f["id"] in to_delete]
-        
-        if not deleted_names:
+        formula = self._id_index.get(formula_id)
+        if formula is None:
             return False, []
+
+        # 获取要删除的节点及其所有子节点（先序）
+        descendants = [formula] + [node for node, _ in self._iter_tree(formula_id)]
+        deleted_names = [node.name for node in descendants]
         
         if confirm is False:
             return True, deleted_names
         
         # 删除指定节点及其子节点
-        self._formulas = [f for f in self._formulas if f["id"] not in to_delete]
-        
-        # 更新其他节点的children
-        for formula in self._formulas:
-            formula["children"] = [c for c in formula["children"] if c not in to_delete]
+        to_delete = {node.id for node in descendants}
+        root_id = self._root_index.get(formula_id)
+        if root_id is not None:
+            self._flat_trees.pop(root_id, None)
+
+        for node_id in to_delete:
+            del self._id_index[node_id]
+            self._children_index.pop(node_id, None)
+            self._root_index.pop(node_id, None)
+        self._active_ids -= to_delete
+
+        # 后代节点的父节点都在删除集合内，只需更新被删节点的父节点
+        parent_id = formula.parent
+        siblings = self._children_index.get(parent_id)
+        if siblings is not None:
+            siblings.remove(formula_id)
+        parent = self._id_index.get(parent_id)
+        if parent:
+            parent.children = [c for c in parent.children if c != formula_id]
         
         self._save_data()
         return True, deleted_names
     
-    def get_formula_by_id(self, formula_id: int) -> Optional[Dict]:
+    def get_formula_by_id(self, formula_id: int) -> Optional[FormulaNode]:
         """根据ID获取定式"""
-        for formula in self._formulas:
-            if formula["id"] == formula_id:
-                return formula
-        return None
+        return self._id_index.get(formula_id)
     
-    def get_formula_by_name(self, name: str) -> Optional[Dict]:
+    def get_root_of(self, formula_id: int) -> Optional[int]:
+        """获取定式所在树的根节点ID，定式不存在时返回None"""
+        return self._root_index.get(formula_id)
+    
+    def get_formula_by_name(self, name: str) -> Optional[FormulaNode]:
         """根据名称获取定式"""
-        for formula in self._formulas:
-            if formula["name"] == name:
+        for formula in self._id_index.values():
+            if formula.name == name:
                 return formula
         return None
     
-    def get_root_formulas(self) -> List[Dict]:
+    def get_root_formulas(self) -> List[FormulaNode]:
         """获取所有根节点定式"""
-        return [f for f in self._formulas if f["parent"] is None]
+        return self.get_children_formulas(None)
     
-    def get_children_formulas(self, parent_id: int) -> List[Dict]:
+    def get_children_formulas(self, parent_id: Optional[int]) -> List[FormulaNode]:
         """获取指定节点的子定式"""
-        return [f for f in self._formulas if f["parent"] == parent_id]
+        return [self._id_index[i] for i in self._children_index.get(parent_id, [])]
 
-    def get_nodes_at_level(self, root_id: int, level: int) -> List[Dict]:
+    def get_nodes_at_level(self, root_id: int, level: int) -> List[FormulaNode]:
         """
         获取指定树在特定层级的所有节点
         
@@ -211,26 +333,37 @@ class FormulaManager:
         Returns:
             在指定层级的所有节点的列表
         """
-        if level < 0:
+        if level < 0 or root_id not in self._id_index:
             return []
 
-        # Start with the root node at level 0
-        nodes_at_current_level = [self.get_formula_by_id(root_id)]
-        
-        # Iteratively find children for each level up to the target level
-        for _ in range(level):
-            next_level_nodes = []
-            # If the current level is empty, we can't go deeper
-            if not nodes_at_current_level:
-                return []
-            for node in nodes_at_current_level:
-                if node: # Should always be true unless data is inconsistent
-                    children = self.get_children_formulas(node['id'])
-                    next_level_nodes.extend(children)
-            nodes_at_current_level = next_level_nodes
+        bfs_ids, level_offsets = self._get_flat_tree(root_id)
+        if level + 1 >= len(level_offsets):
+            return []
+        return [self._id_index[i] for i in bfs_ids[level_offsets[level]:level_offsets[level + 1]]]
+
+    def _get_flat_tree(self, root_id: int) -> Tuple[List[int], List[int]]:
+        """
+        获取指定树按层序展开的扁平数组（按需构建并缓存）
         
-        # Filter out any potential None values if get_formula_by_id returned None initially
-        return [node for node in nodes_at_current_level if node]
+        Returns:
+            (节点ID数组, 层级偏移)，第 L 层的节点为 bfs_ids[offsets[L]:offsets[L + 1]]
+        """
+        flat_tree = self._flat_trees.get(root_id)
+        if flat_tree is None:
+            bfs_ids = [root_id]
+            level_offsets = [0]
+            level_start = 0
+            while level_start < len(bfs_ids):
+                level_end = len(bfs_ids)
+                level_offsets.append(level_end)
+                for i in range(level_start, level_end):
+                    bfs_ids.extend(self._children_index.get(bfs_ids[i], ()))
+                level_start = level_end
+            flat_tree = (bfs_ids, level_offsets)
+            # 只缓存整棵树；子树的缓存无法随所在树的变化而失效
+            if self._root_index.get(root_id) == root_id:
+                self._flat_trees[root_id] = flat_tree
+        return flat_tree
 
     def execute_next_level(self, root_id: int) -> bool:
         """
@@ -269,47 +402,56 @@ class FormulaManager:
         if not self.active_tree_progress:
             return "当前没有活跃的定式树。"
 
-        display_parts = []
-        # 对活跃树按ID排序，以确保显示顺序稳定
-        sorted_active_trees = sorted(self.active_tree_progress.items())
+        # 对活跃树按ID排序，以确保显示顺序稳定；只在活跃树增减时重新排序
+        if self._sorted_active is None or len(self._sorted_active) != len(self.active_tree_progress):
+            self._sorted_active = sorted(self.active_tree_progress)
+        sorted_active_trees = tuple((root_id, self.active_tree_progress[root_id])
+                                    for root_id in self._sorted_active)
 
+        # 数据和进度都未变化时直接返回上次的结果
+        cache_key = (self._mutation_seq, sorted_active_trees)
+        if self._display_cache and self._display_cache[0] == cache_key:
+            return self._display_cache[1]
+
+        tree_blocks = []
         for root_id, current_level in sorted_active_trees:
-            root_node = self.get_formula_by_id(root_id)
+            root_node = self._id_index.get(root_id)
             if not root_node:
                 continue
-            
-            tree_name = root_node.get('name', f"ID: {root_id}")
-            header = f"🌳 {tree_name} (当前层级: {current_level}):"
-            display_parts.append(header)
-            
+
+            lines = [f"🌳 {root_node.name} (当前层级: {current_level}):"]
             nodes_at_level = self.get_nodes_at_level(root_id, current_level)
-            
-            if not nodes_at_level:
-                display_parts.append("  - (当前层级无任务)")
+            if nodes_at_level:
+                lines.extend(f"  - {node.name}" for node in nodes_at_level)
             else:
-                for node in nodes_at_level:
-                    display_parts.append(f"  - {node.get('name', '未知任务')}")
-            display_parts.append("") # 添加空行以分隔不同的树
-        
-        return "\n".join(display_parts)
+                lines.append("  - (当前层级无任务)")
+            tree_blocks.append("\n".join(lines))
+
+        # 不同的树之间以空行分隔
+        display = "\n\n".join(tree_blocks)
+        self._display_cache = (cache_key, display)
+        return display
 
     def change_formula_status(self, formula_id: int) -> bool:
         """切换定式的状态（活跃/未执行）"""
         formula = self.get_formula_by_id(formula_id)
         if formula:
-            is_root = formula.get('parent') is None
+            is_root = formula.parent is None
             
-            if formula['status'] == '活跃':
-                formula['status'] = '未执行'
+            formula.status ^= 1  # STATUS_ACTIVE <-> STATUS_IDLE
+            if formula.status == STATUS_IDLE:
+                self._active_ids.discard(formula_id)
                 # 如果是根节点，从进度跟踪中移除
                 if is_root and formula_id in self.active_tree_progress:
                     del self.active_tree_progress[formula_id]
+                    self._sorted_active = None
             else:
-                formula['status'] = '活跃'
-                formula['last_active_time'] = date.today().isoformat()
+                formula.last_active_ord = date.today().toordinal()
+                self._active_ids.add(formula_id)
                 # 如果是根节点，添加到进度跟踪中，层级为0
                 if is_root:
                     self.active_tree_progress[formula_id] = 0
+                    self._sorted_active = None
             
             self._save_data()
             return True
@@ -324,46 +466,55 @@ class FormulaManager:
         
         formula = self.get_formula_by_id(formula_id)
         if formula:
-            formula["name"] = new_name.strip()
+            formula.name = new_name.strip()
             self._save_data()
             return True
         return False
     
     def get_formula_count(self) -> int:
         """获取定式总数"""
-        return len(self._formulas)
+        return len(self._id_index)
     
 
     
     def clear_all_formulas(self) -> bool:
         """清空所有定式"""
-        self._formulas = []
+        self._rebuild_index([])
         self._save_data()
         return True
     
     def export_formulas(self) -> str:
         """导出定式数据为JSON字符串"""
-        return json.dumps(self._formulas, ensure_ascii=False, indent=2)
+        return fast_json.dumps([f.to_json() for f in self._id_index.values()], pretty=True).decode('utf-8')
     
     def check_inactive_formulas(self) -> List[str]:
         """检查并返回超过一周未活跃的定式名称列表"""
         inactive_formulas = []
-        one_week_ago = date.today() - timedelta(days=7)
-        for formula in self._formulas:
-            if formula['status'] == '活跃' and formula['last_active_time']:
-                last_active = date.fromisoformat(formula['last_active_time'])
-                if last_active < one_week_ago:
-                    inactive_formulas.append(formula['name'])
+        one_week_ago = date.today().toordinal() - 7
+        # 只扫描活跃定式，不必遍历整个定式列表
+        for formula_id in sorted(self._active_ids):
+            formula = self._id_index[formula_id]
+            last_active_ord = formula.last_active_ord
+            if last_active_ord and last_active_ord < one_week_ago:
+                inactive_formulas.append(formula.name)
         return inactive_formulas
 
     def import_formulas(self, json_data: str) -> bool:
         """从JSON字符串导入定式数据"""
         try:
-            formulas = json.loads(json_data)
-            if isinstance(formulas, list):
-                self._formulas = formulas
-                self._save_data()
-                return True
-        except json.JSONDecodeError:
-            pass
-        return False
+            formulas = fast_json.loads(json_data)
+            if not isinstance(formulas, list):
+                return False
+            nodes = [FormulaNode.from_json(f) for f in formulas]
+        except (json.JSONDecodeError, KeyError, TypeError, ValueError, AttributeError):
+            # 格式错误的记录不应影响现有数据
+            return False
+        # ID和父ID必须是整数，否则无法建立索引
+        if not all(isinstance(n.id, int) and (n.parent is None or isinstance(n.parent, int)) for n in nodes):
+            return False
+        # ID不能重复，定式也不能以自身为父节点
+        if len({n.id for n in nodes}) != len(nodes) or any(n.parent == n.id for n in nodes):
+            return False
+        self._rebuild_index(nodes)
+        self._save_data()
+        return True
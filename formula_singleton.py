@@ -3,13 +3,16 @@
 使用 get_manager() 获取全局唯一的 FormulaManager 实例。
 首次调用可传入 data_callback，用于持久化。
 后续调用忽略 data_callback 参数，直接返回已创建的实例。
+创建过程由模块级锁保护，多线程同时首次调用也只会创建一个实例。
 """
+import threading
 from typing import Optional, Callable, Any
 
 from formula_manager import FormulaManager
 
 # 私有单例实例
-_instance: Optional[FormulaManager] = None 
+_instance: Optional[FormulaManager] = None
+_lock = threading.Lock()
 
 def get_manager(data_callback: Optional[Callable[[], Any]] = None) -> FormulaManager:
     """获取 FormulaManager 单例。
@@ -22,10 +25,16 @@ def get_manager(data_callback: Optional[Callable[[], Any]] = None) -> FormulaMan
     """
     global _instance
 
+    # 双重检查：实例已创建且无需注入回调时不加锁
     if _instance is None:
-        _instance = FormulaManager(data_callback=data_callback)
-    else:
-        # 如果已存在实例，但之前未设置回调，可补充注入
-        if data_callback and _instance.data_callback is None:
-            _instance.data_callback = data_callback
+        with _lock:
+            if _instance is None:
+                _instance = FormulaManager(data_callback=data_callback)
+                return _instance
+
+    # 如果已存在实例，但之前未设置回调，可补充注入
+    if data_callback and _instance.data_callback is None:
+        with _lock:
+            if _instance.data_callback is None:
+                _instance.data_callback = data_callback
     return _instance
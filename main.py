@@ -7,14 +7,18 @@ Chain Delay Protocol Management System
 基于"神圣座位原理"和"下必为例原则"的行为管理工具
 """
 
-import json
+import atexit
 import os
-import time
 import threading
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Any
+
+import fast_json
 from formula_singleton import get_manager
 
+# 数据修改后延迟写盘的秒数，期间的多次修改合并为一次写入
+SAVE_DELAY_SECONDS = 0.5
+
 
 class ChainDelayProtocol:
     def __init__(self, update_callback=None):
@@ -22,20 +26,32 @@ class ChainDelayProtocol:
         self.data = self.load_data()
         self.update_callback = update_callback
 
+        # 延迟写盘状态
+        self._dirty = False
+        self._save_timer: Optional[threading.Timer] = None
+        self._save_lock = threading.Lock()
+        atexit.register(self._flush_to_disk)
+
+        # 缓存链长与最长链记录，避免每次查询都访问 self.data
+        self._chain_len = len(self.data['task_chain'])
+        self._longest_chain = self.data.get('longest_chain', 0)
+
         # 初始化定式管理器
-        self.formula_manager = get_manager(data_callback=self.save_data)
+        self.formula_manager = get_manager(data_callback=self._on_formulas_changed)
         self.formula_manager.set_formulas_data(self.data.get("formulas", {}))
+        # 定式数据的快照，在修改定式的线程上生成，写盘线程只读取它
+        self._formulas_data = self.formula_manager.get_formulas_data()
 
         # 运行时状态
         self.reservation_active = False
         self.reservation_end_time = None
         self.task_active = False
         self.task_end_time = None
-        self.timer_thread = None
+        self._timer: Optional[threading.Timer] = None
 
         # 启动时打印历史信息
         print("="*50)
-        print(f"👑 历史最长链: {self.data.get('longest_chain', 0)} 节点")
+        print(f"👑 历史最长链: {self._longest_chain} 节点")
         if self.data.get('task_history'):
             print("📜 最近任务:")
             for task in self.data['task_history'][-5:]:
@@ -61,8 +77,8 @@ class ChainDelayProtocol:
 
         if os.path.exists(self.data_file):
             try:
-                with open(self.data_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
+                with open(self.data_file, 'rb') as f:
+                    data = fast_json.loads(f.read())
                 # 合并默认数据和加载的数据
                 for key, value in default_data.items():
                     if key not in data:
@@ -74,16 +90,45 @@ class ChainDelayProtocol:
         else:
             return default_data
 
-    def save_data(self):
-        """保存数据到文件"""
-        self.data['formulas'] = self.formula_manager.get_formulas_data()
-        
-        with open(self.data_file, 'w', encoding='utf-8') as f:
-            json.dump(self.data, f, ensure_ascii=False, indent=4)
+    def _mark_dirty(self):
+        """标记数据已修改，并安排一次延迟写盘"""
+        with self._save_lock:
+            self._dirty = True
+            if self._save_timer is None:
+                self._save_timer = threading.Timer(SAVE_DELAY_SECONDS, self._flush_to_disk)
+                self._save_timer.daemon = True
+                self._save_timer.start()
 
         if self.update_callback:
             self.update_callback()
 
+    def _on_formulas_changed(self):
+        """定式数据修改后立即生成快照，避免写盘线程与修改线程同时遍历定式"""
+        formulas_data = self.formula_manager.get_formulas_data()
+        with self._save_lock:
+            self._formulas_data = formulas_data
+        self._mark_dirty()
+
+    def _flush_to_disk(self):
+        """立即将未保存的修改写入文件"""
+        with self._save_lock:
+            if self._save_timer:
+                self._save_timer.cancel()
+                self._save_timer = None
+            if not self._dirty:
+                return
+
+            self.data['formulas'] = self._formulas_data
+            self.data['longest_chain'] = self._longest_chain
+
+            # 先写临时文件再替换，避免写入中断导致数据文件损坏
+            tmp_file = f"{self.data_file}.tmp"
+            with open(tmp_file, 'wb') as f:
+                f.write(fast_json.dumps(self.data))
+            os.replace(tmp_file, self.data_file)
+            # 写入成功后才清除标记，失败时下次修改或退出时会重试
+            self._dirty = False
+
     def start_reservation(self, minutes: Optional[int] = None):
         """启动预约链"""
         if self.reservation_active or self.task_active:
@@ -99,22 +144,25 @@ class ChainDelayProtocol:
         print(f"⏰ 必须在 {reservation_minutes} 分钟内触发'神圣座位'")
         print(f"⏱️  截止时间: {self.reservation_end_time.strftime('%H:%M:%S')}")
 
-        # 启动计时器线程
-        self.timer_thread = threading.Thread(target=self._reservation_timer)
-        self.timer_thread.daemon = True
-        self.timer_thread.start()
+        # 到期时触发一次回调
+        self._arm_timer(reservation_minutes * 60, self._on_reservation_timeout)
         return True
 
-    def _reservation_timer(self):
-        """预约链计时器"""
-        while self.reservation_active and datetime.now() < self.reservation_end_time:
-            remaining = (self.reservation_end_time -
-                         datetime.now()).total_seconds()
-            if remaining > 0:
-                time.sleep(1)
-            else:
-                break
-
+    def _arm_timer(self, seconds: float, callback):
+        """取消现有计时器并启动新的单次计时器"""
+        self._cancel_timer()
+        self._timer = threading.Timer(max(seconds, 0), callback)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _cancel_timer(self):
+        """取消尚未触发的计时器"""
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+    def _on_reservation_timeout(self):
+        """预约链到期回调"""
         if self.reservation_active:
             print(f"\n⚠️  预约链超时！")
             print("请选择处理方式:")
@@ -131,6 +179,7 @@ class ChainDelayProtocol:
         # 如果预约是激活的，就停止它
         if self.reservation_active:
             self.reservation_active = False
+            self._cancel_timer()
             print("\n🔔 预约链已完成，神圣座位触发！")
 
         task_minutes = minutes if minutes is not None else self.data["settings"]["task_minutes"]
@@ -139,35 +188,27 @@ class ChainDelayProtocol:
         self.task_active = True
         self.task_end_time = datetime.now() + timedelta(minutes=task_minutes)
 
-        new_node_id = len(self.data["task_chain"]) + 1
+        new_node_id = self._chain_len + 1
         new_node = {
             "id": new_node_id,
             "name": task_name,
             "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         }
         self.data["task_chain"].append(new_node)
-        self.save_data()
+        self._chain_len = new_node_id
+        self._mark_dirty()
 
         print(f"\n👑 任务 '#{new_node_id} [{task_name}]' 已开始！")
         print(f"⏳ 任务时长: {task_minutes} 分钟")
         print(f"⏱️  预计完成: {self.task_end_time.strftime('%H:%M:%S')}")
 
-        # 启动任务计时器线程
-        self.timer_thread = threading.Thread(target=self._task_timer)
-        self.timer_thread.daemon = True
-        self.timer_thread.start()
+        # 到期时自动完成任务
+        self._arm_timer(task_minutes * 60, self._on_task_timeout)
 
         return True
 
-    def _task_timer(self):
-        """任务计时器"""
-        while self.task_active and datetime.now() < self.task_end_time:
-            remaining = (self.task_end_time - datetime.now()).total_seconds()
-            if remaining > 0:
-                time.sleep(1)
-            else:
-                break
-
+    def _on_task_timeout(self):
+        """任务到期回调"""
         if self.task_active:
             self.complete_task()
 
@@ -185,18 +226,19 @@ class ChainDelayProtocol:
             print(f"\n🎉 任务按时完成！")
 
         self.task_active = False
-        current_chain_length = len(self.data['task_chain'])
+        self._cancel_timer()
+        current_chain_length = self._chain_len
         last_task = self.data['task_chain'][-1]
 
         print(
             f"🔗 任务 '#{last_task['id']} [{last_task['name']}]' 已完成。当前链长: {current_chain_length}")
 
         # 更新最长链记录
-        if current_chain_length > self.data.get('longest_chain', 0):
-            self.data['longest_chain'] = current_chain_length
+        if current_chain_length > self._longest_chain:
+            self._longest_chain = current_chain_length
             print(f"👑 新纪录！最长链更新为: {current_chain_length}")
 
-        self.save_data()
+        self._mark_dirty()
         return True
 
     def stop_task(self):
@@ -206,6 +248,8 @@ class ChainDelayProtocol:
             return
 
         self.task_active = False
+        self._cancel_timer()
+        self._flush_to_disk()
         print("⏹️  任务已停止")
 
     def reset_chain(self, description: str):
@@ -221,9 +265,11 @@ class ChainDelayProtocol:
             self.data['task_history'] = self.data['task_history'][-20:]
 
         self.data["task_chain"] = []
+        self._chain_len = 0
         self.task_active = False
         self.reservation_active = False
-        self.save_data()
+        self._cancel_timer()
+        self._mark_dirty()
         print(f"\n🔄 任务链已重置")
         print(f"📝 重置原因: {description}")
         print("⚡ 下次将从 #1 重新开始")
@@ -238,7 +284,7 @@ class ChainDelayProtocol:
         }
 
         self.data["allowed_violations"].append(violation)
-        self.save_data()
+        self._mark_dirty()
 
         print(f"\n✅ 行为已永久允许")
         print(f"📝 允许行为: {description}")
@@ -274,10 +320,10 @@ class ChainDelayProtocol:
             print("🎯 任务链: 未激活")
 
         # 最长链记录
-        print(f"👑 历史最长链: {self.data.get('longest_chain', 0)} 节点")
+        print(f"👑 历史最长链: {self._longest_chain} 节点")
 
         # 任务链节点
-        print(f"\n📈 当前任务链 ({len(self.data['task_chain'])} 节):")
+        print(f"\n📈 当前任务链 ({self._chain_len} 节):")
         if self.data["task_chain"]:
             for node in self.data["task_chain"]:
                 print(
@@ -7,50 +7,152 @@ Chain Delay Protocol Management System - GUI Interface
 基于tkinter的现代化图形用户界面
 """
 
+import io
+import itertools
 import tkinter as tk
+import tkinter.font as tkfont
 from tkinter import ttk, messagebox, scrolledtext
 import threading
 import time
 import sys
+from collections import deque
+from contextlib import contextmanager
 from main import ChainDelayProtocol
 from formula_singleton import get_manager  # noqa: F401 (imported for potential future use)
 
-def center_window(window):
+# Log output is buffered and written to the widget at most once per interval
+LOG_FLUSH_INTERVAL_MS = 50
+# Upper bound on buffered, not yet flushed log characters; oldest writes are dropped first
+LOG_MAX_BUFFER_CHARS = 1_000_000
+# The log widget keeps only the most recent lines
+LOG_MAX_LINES = 5000
+
+_STYLES_INIT = False
+# Tk deletes a named font once its Font object is garbage collected, so keep them referenced
+_STYLE_FONTS = []
+
+def _init_styles(root):
+    """Configure the ttk theme and shared styles once per process."""
+    global _STYLES_INIT
+    if _STYLES_INIT:
+        return
+    style = ttk.Style(root)
+    style.theme_use('clam')
+    base_font = tkfont.Font(root=root, family='Helvetica', size=12)
+    header_font = tkfont.Font(root=root, family='Helvetica', size=16, weight='bold')
+    style.configure('TButton', font=base_font, padding=10)
+    style.configure('TLabel', font=base_font)
+    style.configure('Header.TLabel', font=header_font)
+    _STYLE_FONTS.extend((base_font, header_font))
+    _STYLES_INIT = True
+
+def center_window(window, width=None, height=None):
+    """Center window on screen.
+
+    With an explicit size the geometry is set directly, without a layout pass.
+    Otherwise the pending layout is finished first and only the position is
+    set, so the window keeps the size its contents request.
+    """
+    if width and height:
+        x = (window.winfo_screenwidth() // 2) - (width // 2)
+        y = (window.winfo_screenheight() // 2) - (height // 2)
+        window.geometry(f'{width}x{height}+{x}+{y}')
+        return
     window.update_idletasks()
-    width = window.winfo_width()
-    height = window.winfo_height()
-    x = (window.winfo_screenwidth() // 2) - (width // 2)
-    y = (window.winfo_screenheight() // 2) - (height // 2)
-    window.geometry(f'{width}x{height}+{x}+{y}')
+    x = (window.winfo_screenwidth() // 2) - (window.winfo_reqwidth() // 2)
+    y = (window.winfo_screenheight() // 2) - (window.winfo_reqheight() // 2)
+    window.geometry(f'+{x}+{y}')
 
 
 
 class TextRedirector:
-    """A class to redirect stdout to a tkinter Text widget."""
+    """A class to redirect stdout to a tkinter Text widget.
+
+    Writes are collected in a buffer and inserted into the widget in one batch
+    per LOG_FLUSH_INTERVAL_MS, so chatty output costs one Tk update per tick.
+    """
     def __init__(self, widget):
         self.widget = widget
+        self._buf = deque()
+        self._buf_len = 0
+        self._scheduled = False
+        # write() is also called from the protocol's timer threads
+        self._lock = threading.Lock()
 
     def write(self, text):
+        if not text:
+            return
+        with self._lock:
+            self._buf.append(text)
+            self._buf_len += len(text)
+            while self._buf_len > LOG_MAX_BUFFER_CHARS and len(self._buf) > 1:
+                self._buf_len -= len(self._buf.popleft())
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self.widget.after(LOG_FLUSH_INTERVAL_MS, self._flush)
+
+    def _flush(self):
+        with self._lock:
+            chunk = ''.join(self._buf)
+            self._buf.clear()
+            self._buf_len = 0
+            self._scheduled = False
+        if not chunk:
+            return
         self.widget.configure(state='normal')
-        self.widget.insert('end', text)
+        self.widget.insert('end', chunk)
+        line_count = int(self.widget.index('end-1c').split('.')[0])
+        if line_count > LOG_MAX_LINES:
+            self.widget.delete('1.0', f'{line_count - LOG_MAX_LINES + 1}.0')
         self.widget.see('end')
         self.widget.configure(state='disabled')
 
     def flush(self):
         pass
 
+
+@contextmanager
+def batched_stdout():
+    """Collect everything printed inside the block and hand it to stdout in one write."""
+    real_stdout = sys.stdout
+    buf = io.StringIO()
+    sys.stdout = buf
+    try:
+        yield
+    finally:
+        sys.stdout = real_stdout
+        real_stdout.write(buf.getvalue())
+
+def _stub_iid(formula_iid):
+    """Treeview iid of the placeholder child shown under a not yet opened formula."""
+    return f'__stub_{formula_iid}'
+
 class FormulaManagerGUI:
     """GUI for managing formulas in a separate window."""
     def __init__(self, parent, formula_manager):
         self.window = tk.Toplevel(parent)
         self.window.title("管理定式")
-        self.window.geometry("500x600")
         self.window.transient(parent)
         self.window.grab_set()
 
         self.formula_manager = formula_manager
+        # Treeview iid -> formula id, so actions don't have to parse the iid string
+        self._iid_to_id = {}
         self.create_widgets()
-        center_window(self.window)
+        center_window(self.window, 500, 600)
+        # Closing only hides the window so it can be reopened without rebuilding
+        self.window.protocol('WM_DELETE_WINDOW', self.hide)
+
+    def show(self):
+        self.window.deiconify()
+        self.window.lift()
+        self.window.grab_set()
+        self.refresh_tree()
+
+    def hide(self):
+        self.window.grab_release()
+        self.window.withdraw()
 
     def create_widgets(self):
         tree_frame = ttk.LabelFrame(self.window, text="定式树", padding=10)
@@ -59,7 +161,11 @@ class FormulaManagerGUI:
         self.tree_view = ttk.Treeview(tree_frame, columns=("status",), show="tree headings")
         self.tree_view.heading("#0", text="定式内容")
         self.tree_view.heading("status", text="状态")
+        self.tree_scrollbar = ttk.Scrollbar(tree_frame, orient="vertical", command=self.tree_view.yview)
+        self.tree_view.configure(yscrollcommand=self.tree_scrollbar.set)
+        self.tree_scrollbar.pack(side="right", fill="y")
         self.tree_view.pack(expand=True, fill="both")
+        self.tree_view.bind('<<TreeviewOpen>>', self._on_open)
 
         self.refresh_tree()
 
@@ -89,16 +195,48 @@ class FormulaManagerGUI:
         change_status_button.pack(pady=5, side="right", padx=5)
 
     def refresh_tree(self):
-        for i in self.tree_view.get_children():
-            self.tree_view.delete(i)
-        self.populate_tree(None, '')
+        """Rebuild the whole tree; single edits go through the _*_item helpers instead."""
+        # Unmap the widget and detach the scrollbar while rebuilding so Tk lays
+        # it out and reports the scroll range once at the end. The saved value
+        # is the Tcl command name, so restoring it doesn't register a new one.
+        yscrollcommand = self.tree_view.cget('yscrollcommand')
+        self.tree_view.pack_forget()
+        self.tree_view.configure(yscrollcommand='')
+        try:
+            self.tree_view.delete(*self.tree_view.get_children())
+            self._iid_to_id.clear()
+            self.populate_tree(None, '')
+        finally:
+            self.tree_view.configure(yscrollcommand=yscrollcommand)
+            self.tree_view.pack(expand=True, fill="both")
 
     def populate_tree(self, parent_id, parent_node):
-        formulas_data = self.formula_manager.get_formulas_data()
-        children = [f for f in formulas_data.get('formulas', []) if f["parent"] == parent_id]
-        for child in children:
-            node = self.tree_view.insert(parent_node, 'end', iid=child['id'], text=child['name'], values=(child['status'],))
-            self.populate_tree(child['id'], node)
+        """Insert only the direct children of parent_id; deeper levels load when a node is opened."""
+        for child in self.formula_manager.get_children_formulas(parent_id):
+            self._insert_item(child, parent_node)
+
+    def _on_open(self, event):
+        item = self.tree_view.focus()
+        stub = _stub_iid(item)
+        if item and self.tree_view.exists(stub):
+            self.tree_view.delete(stub)
+            self.populate_tree(self._iid_to_id[item], item)
+
+    def _insert_item(self, formula, parent_node):
+        iid = self.tree_view.insert(parent_node, 'end', iid=formula.id, text=formula.name, values=(formula.status_text,))
+        self._iid_to_id[iid] = formula.id
+        if self.formula_manager.get_children_formulas(formula.id):
+            # Placeholder child so Tk draws the expand indicator
+            self.tree_view.insert(formula.id, 'end', iid=_stub_iid(formula.id))
+
+    def _update_item(self, formula):
+        self.tree_view.item(formula.id, text=formula.name, values=(formula.status_text,))
+
+    def _remove_item(self, iid):
+        # Tk removes all descendant items along with the item itself; their
+        # map entries are left until the next full refresh since ids are never reused
+        self.tree_view.delete(iid)
+        self._iid_to_id.pop(iid, None)
 
     def add_formula_action(self):
         name = self.name_entry.get().strip()
@@ -107,13 +245,17 @@ class FormulaManagerGUI:
             return
 
         selected_item = self.tree_view.focus()
-        parent_id = int(selected_item) if selected_item else None
+        parent_id = self._iid_to_id[selected_item] if selected_item else None
 
         success, message = self.formula_manager.add_formula(name, parent_id)
 
         if success:
             messagebox.showinfo("成功", message, parent=self.window)
-            self.refresh_tree()
+            # An unopened parent loads the new formula together with its other children
+            if not self.tree_view.exists(_stub_iid(selected_item)):
+                # The new formula is always the last child of its parent
+                new_formula = self.formula_manager.get_children_formulas(parent_id)[-1]
+                self._insert_item(new_formula, selected_item)
             self.name_entry.delete(0, 'end')
         else:
             messagebox.showerror("错误", message, parent=self.window)
@@ -124,9 +266,9 @@ class FormulaManagerGUI:
             messagebox.showwarning("警告", "请选择一个定式", parent=self.window)
             return
 
-        formula_id = int(selected_item)
-        self.formula_manager.change_formula_status(formula_id)
-        self.refresh_tree()
+        formula_id = self._iid_to_id[selected_item]
+        if self.formula_manager.change_formula_status(formula_id):
+            self._update_item(self.formula_manager.get_formula_by_id(formula_id))
 
     def remove_formula_action(self):
         selected_item = self.tree_view.focus()
@@ -134,18 +276,18 @@ class FormulaManagerGUI:
             messagebox.showwarning("警告", "请在树中选择要删除的定式", parent=self.window)
             return
 
-        remove_id = int(selected_item)
+        remove_id = self._iid_to_id[selected_item]
         formula = self.formula_manager.get_formula_by_id(remove_id)
         if not formula:
             messagebox.showerror("错误", f"未找到ID为 {remove_id} 的定式", parent=self.window)
             return
 
-        confirm = messagebox.askyesno("确认删除", f"确定要删除定式 '{formula['name']}' 及其所有子定式吗？", parent=self.window)
+        confirm = messagebox.askyesno("确认删除", f"确定要删除定式 '{formula.name}' 及其所有子定式吗？", parent=self.window)
         if confirm:
             success, deleted_names = self.formula_manager.remove_formula(remove_id, confirm=True)
             if success:
                 messagebox.showinfo("成功", f"定式 '{', '.join(deleted_names)}' 已被删除", parent=self.window)
-                self.refresh_tree()
+                self._remove_item(selected_item)
             else:
                 messagebox.showerror("错误", "删除失败", parent=self.window)
 
@@ -229,15 +371,18 @@ class ChainDelayProtocolGUI:
         self.root.title("链式时延协议管理系统")
         self.root.geometry("650x750")
 
-        self.style = ttk.Style()
-        self.style.theme_use('clam')
-        self.style.configure('TButton', font=('Helvetica', 12), padding=10)
-        self.style.configure('TLabel', font=('Helvetica', 12))
-        self.style.configure('Header.TLabel', font=('Helvetica', 16, 'bold'))
+        _init_styles(self.root)
+        # Shared fonts so each widget doesn't re-resolve a font tuple
+        self._bold11 = tkfont.Font(root=self.root, family='Helvetica', size=11, weight='bold')
+        self._bold12 = tkfont.Font(root=self.root, family='Helvetica', size=12, weight='bold')
+        self._mono = tkfont.Font(root=self.root, family='Consolas', size=10)
 
+        self._last_status_version = None
+        self._status_dirty = False
+        self._fm_gui = None
         self.create_widgets()
         self.protocol = ChainDelayProtocol()
-        self.protocol.update_callback = self.update_formula_status_bar
+        self.protocol.update_callback = self._schedule_status_update
         self.update_formula_status_bar()
         self.check_for_inactive_formulas()
 
@@ -263,39 +408,30 @@ class ChainDelayProtocolGUI:
         control_frame.grid(row=1, column=0, sticky="ns", padx=(0, 10))
         control_frame.columnconfigure(0, weight=1)
 
-        # --- Core Actions ---
-        ttk.Label(control_frame, text="核心操作", font=('Helvetica', 11, 'bold')).grid(row=0, column=0, sticky='w', pady=(0, 5))
-        core_buttons = [
-            ("启动预约链", self.start_reservation),
-            ("触发神圣座位", self.start_task),
-            ("完成任务", self.complete_task),
-            ("处理违规", self.handle_violation),
-        ]
-        for i, (text, command) in enumerate(core_buttons, start=1):
-            button = ttk.Button(control_frame, text=text, command=command)
-            button.grid(row=i, column=0, sticky="ew", pady=3)
-
-        # --- View Actions ---
-        ttk.Separator(control_frame, orient='horizontal').grid(row=len(core_buttons)+1, column=0, sticky='ew', pady=10)
-        ttk.Label(control_frame, text="查看", font=('Helvetica', 11, 'bold')).grid(row=len(core_buttons)+2, column=0, sticky='w', pady=(0, 5))
-        view_buttons = [
-            ("查看状态", self.show_status),
-            ("查看允许规则", self.show_allowed_rules),
+        sections = [
+            ("核心操作", [
+                ("启动预约链", self.start_reservation),
+                ("触发神圣座位", self.start_task),
+                ("完成任务", self.complete_task),
+                ("处理违规", self.handle_violation),
+            ]),
+            ("查看", [
+                ("查看状态", self.show_status),
+                ("查看允许规则", self.show_allowed_rules),
+            ]),
+            ("管理", [
+                ("管理定式", self.open_formula_manager),
+                ("执行下一层", self.execute_next_formula_level),
+            ]),
         ]
-        for i, (text, command) in enumerate(view_buttons, start=len(core_buttons)+3):
-            button = ttk.Button(control_frame, text=text, command=command)
-            button.grid(row=i, column=0, sticky="ew", pady=3)
-
-        # --- Management Actions ---
-        ttk.Separator(control_frame, orient='horizontal').grid(row=len(core_buttons)+len(view_buttons)+3, column=0, sticky='ew', pady=10)
-        ttk.Label(control_frame, text="管理", font=('Helvetica', 11, 'bold')).grid(row=len(core_buttons)+len(view_buttons)+4, column=0, sticky='w', pady=(0, 5))
-        manage_buttons = [
-            ("管理定式", self.open_formula_manager),
-            ("执行下一层", self.execute_next_formula_level),
-        ]
-        for i, (text, command) in enumerate(manage_buttons, start=len(core_buttons)+len(view_buttons)+5):
-            button = ttk.Button(control_frame, text=text, command=command)
-            button.grid(row=i, column=0, sticky="ew", pady=3)
+        row = itertools.count()
+        for index, (title, buttons) in enumerate(sections):
+            if index:
+                ttk.Separator(control_frame, orient='horizontal').grid(row=next(row), column=0, sticky='ew', pady=10)
+            ttk.Label(control_frame, text=title, font=self._bold11).grid(row=next(row), column=0, sticky='w', pady=(0, 5))
+            for text, command in buttons:
+                button = ttk.Button(control_frame, text=text, command=command)
+                button.grid(row=next(row), column=0, sticky="ew", pady=3)
 
         # Right side for log
         log_frame = ttk.LabelFrame(main_frame, text="系统日志", padding="10")
@@ -303,7 +439,7 @@ class ChainDelayProtocolGUI:
         log_frame.columnconfigure(0, weight=1)
         log_frame.rowconfigure(0, weight=1)
 
-        self.log_text = scrolledtext.ScrolledText(log_frame, wrap=tk.WORD, state='disabled', font=('Consolas', 10))
+        self.log_text = scrolledtext.ScrolledText(log_frame, wrap=tk.WORD, state='disabled', font=self._mono)
         self.log_text.grid(row=0, column=0, sticky="nsew")
 
         # Bottom area for active formulas status
@@ -326,11 +462,13 @@ class ChainDelayProtocolGUI:
         sys.stdout = TextRedirector(self.log_text)
 
     def show_status(self):
-        self.protocol.show_status()
+        with batched_stdout():
+            self.protocol.show_status()
 
 
     def show_allowed_rules(self):
-        self.protocol.show_allowed_violations()
+        with batched_stdout():
+            self.protocol.show_allowed_violations()
 
     def start_reservation(self):
         dialog = InputDialog(self.root, "启动预约链", ["预约时间(分):"])
@@ -338,10 +476,12 @@ class ChainDelayProtocolGUI:
             try:
                 minutes_str = dialog.result["预约时间(分):"]
                 minutes = int(minutes_str) if minutes_str else None
-                if self.protocol.start_reservation(minutes):
-                    self.start_countdown(minutes if minutes is not None else self.protocol.data["settings"]["reservation_minutes"])
             except ValueError:
                 messagebox.showerror("错误", "分钟数必须是有效的数字")
+                return
+
+            if self.protocol.start_reservation(minutes):
+                self.start_countdown(minutes if minutes is not None else self.protocol.data["settings"]["reservation_minutes"])
 
     def start_task(self):
         dialog = InputDialog(self.root, "触发神圣座位", ["任务时间(分):", "任务名称:"])
@@ -350,10 +490,12 @@ class ChainDelayProtocolGUI:
                 minutes_str = dialog.result["任务时间(分):"]
                 minutes = int(minutes_str) if minutes_str else None
                 task_name = dialog.result["任务名称:"] or None
-                if self.protocol.start_task(minutes, task_name):
-                    self.start_countdown(minutes if minutes is not None else self.protocol.data["settings"]["task_minutes"])
             except ValueError:
                 messagebox.showerror("错误", "分钟数必须是有效的数字")
+                return
+
+            if self.protocol.start_task(minutes, task_name):
+                self.start_countdown(minutes if minutes is not None else self.protocol.data["settings"]["task_minutes"])
 
     def complete_task(self):
         if self.protocol.complete_task():
@@ -384,10 +526,30 @@ class ChainDelayProtocolGUI:
             messagebox.showinfo("操作成功", f"已将‘{description}’添加为例外规则。")
 
     def open_formula_manager(self):
-        FormulaManagerGUI(self.root, self.protocol.formula_manager)
+        if self._fm_gui and self._fm_gui.window.winfo_exists():
+            self._fm_gui.show()
+            return
+        self._fm_gui = FormulaManagerGUI(self.root, self.protocol.formula_manager)
+
+    def _schedule_status_update(self):
+        """Coalesce a burst of protocol callbacks into one status bar update."""
+        if self._status_dirty:
+            return
+        self._status_dirty = True
+        self.root.after_idle(self._do_status_update)
+
+    def _do_status_update(self):
+        self._status_dirty = False
+        self.update_formula_status_bar()
 
     def update_formula_status_bar(self):
         """更新定式状态栏"""
+        # Protocol saves that don't touch formulas leave the text unchanged
+        version = self.protocol.formula_manager.version
+        if version == self._last_status_version:
+            return
+        self._last_status_version = version
+
         display_text = self.protocol.formula_manager.get_active_formulas_display()
         if not display_text:
             display_text = "当前无活跃定式。"
@@ -404,20 +566,21 @@ class ChainDelayProtocolGUI:
             messagebox.showinfo("提示", "当前没有活跃的定式树。", parent=self.root)
             return
 
-        choices = []
+        # Map each button label back to its tree so the choice needs no parsing
+        formula_by_choice = {}
         for root_id in active_trees.keys():
             formula = self.protocol.formula_manager.get_formula_by_id(root_id)
             if formula:
-                choices.append(f"{formula.get('name', f'ID: {root_id}')} (ID: {root_id})")
+                formula_by_choice[f"{formula.name} (ID: {root_id})"] = formula
 
-        dialog = CustomChoiceDialog(self.root, "选择定式树", "请选择要执行下一层的定式树：", choices)
+        dialog = CustomChoiceDialog(self.root, "选择定式树", "请选择要执行下一层的定式树：", list(formula_by_choice))
         choice = dialog.result
         
         if choice:
-            selected_id = int(choice.split('(ID: ')[1][:-1])
-            completed = self.protocol.formula_manager.execute_next_level(selected_id)
+            formula = formula_by_choice[choice]
+            completed = self.protocol.formula_manager.execute_next_level(formula.id)
             
-            formula_name = self.protocol.formula_manager.get_formula_by_id(selected_id).get('name')
+            formula_name = formula.name
             if completed:
                 messagebox.showinfo("操作成功", f"定式树 '{formula_name}' 已完成一轮，重置到初始层级。", parent=self.root)
             else:
@@ -425,41 +588,41 @@ class ChainDelayProtocolGUI:
             
 
     def check_for_inactive_formulas(self):
+        # In-memory scan only, so it stays on the Tk thread
         inactive_list = self.protocol.formula_manager.check_inactive_formulas()
         if inactive_list:
             message = "以下定式已超过一周未激活，请考虑激活或删除：\n\n" + "\n".join(inactive_list)
             messagebox.showwarning("不活跃定式警告", message, parent=self.root)
 
     def start_countdown(self, minutes):
+        # Restarting (e.g. reservation -> task) must not leave the previous expiry scheduled
+        if self.countdown_after_id:
+            self.root.after_cancel(self.countdown_after_id)
+            self.countdown_after_id = None
+
+        self.countdown_end_time = time.time() + minutes * 60
+        self.countdown_active = True
+        # The end time never changes, so the label is rendered once and Tk only
+        # wakes up again when the countdown expires
+        text = f"结束于: {time.strftime('%H:%M:%S', time.localtime(self.countdown_end_time))}"
+
         if self.countdown_window is None:
             win = tk.Toplevel(self.root)
             win.overrideredirect(True)
             win.attributes("-topmost", True)
             win.resizable(False, False)
-            # Small window size & position at bottom-right of screen
-            width, height = 100, 40
-            x = self.root.winfo_screenwidth() - width - 20
-            y = self.root.winfo_screenheight() - height - 60
-            win.geometry(f"{width}x{height}+{x}+{y}")
             self.countdown_window = win
-            self.countdown_label = ttk.Label(win, text="", font=("Helvetica", 12, "bold"))
+            self.countdown_label = ttk.Label(win, text="", font=self._bold12, anchor="center")
             self.countdown_label.pack(expand=True, fill="both")
+        self.countdown_label.config(text=text)
 
-        self.countdown_end_time = time.time() + minutes * 60
-        self.countdown_active = True
-        self.update_countdown()
+        # Small window sized to the text & positioned at bottom-right of screen
+        width, height = max(100, self._bold12.measure(text) + 20), 40
+        x = self.root.winfo_screenwidth() - width - 20
+        y = self.root.winfo_screenheight() - height - 60
+        self.countdown_window.geometry(f"{width}x{height}+{x}+{y}")
 
-    def update_countdown(self):
-        if not self.countdown_active:
-            return
-
-        remaining_seconds = self.countdown_end_time - time.time()
-        if remaining_seconds > 0:
-            mins, secs = divmod(int(remaining_seconds), 60)
-            self.countdown_label.config(text=f"倒计时: {mins:02d}:{secs:02d}")
-            self.countdown_after_id = self.root.after(1000, self.update_countdown)
-        else:
-            self.stop_countdown()
+        self.countdown_after_id = self.root.after(max(int(minutes * 60 * 1000), 0), self.stop_countdown)
 
     def stop_countdown(self):
         self.countdown_active = False